@@ -7,13 +7,16 @@ from fastapi import FastAPI #Response, status, HTTPException, Depends# import th
 #from random import randrange # is used to create a random number or a random intenger
 #from sqlalchemy.orm import Session
 # import the models, base for the below command - model.Base.metadaa.../ # models - import the class Post(Base)- unde se afla tabelul din fileul models
-from . import models    # schemas, utils
+import os
+from . import models, metrics    # schemas, utils
 from .database import engine #get_db
 # connectez folderul routers cu fileul main
 from .routers import post, user, auth, vote
 from .config import settings
 # de pe fastapi.tiangolo -- CORS
 from fastapi.middleware.cors import CORSMiddleware
+# orjson (din requirements) serializeaza mult mai repede decat json din stdlib
+from fastapi.responses import ORJSONResponse
 
 
 
@@ -25,7 +28,8 @@ print(settings.database_username)
 
 
 #continuarea la notitiile din caiet
-app =FastAPI() # creating an instance of fastapi, this code is from api.com website
+# default_response_class=ORJSONResponse - every response (also the big post feeds) is encoded with orjson instead of the stdlib json module
+app =FastAPI(default_response_class=ORJSONResponse) # creating an instance of fastapi, this code is from api.com website
 #all the domains that can talk to api, stored in list, in this case google/ we just have to provide all the website that can access our api
 # if is public/ for everyone using a wildcard ["*"]
 origins = ["https://www.google.com"]
@@ -37,6 +41,10 @@ app.add_middleware(
     allow_methods=["*"],    # allwos all http methods and headers to 
     allow_headers=["*"],
 )
+# request timing + SQL query counting + /metrics, turned on with ENABLE_METRICS=1/ when it's off nothing is added to the requests
+# ENABLE_PROFILER=1 (together with ENABLE_METRICS) also samples the stacks of the slowest requests, see /metrics/slow
+if os.getenv("ENABLE_METRICS", "").lower() in ("1", "true", "yes"):
+    metrics.setup(app, engine, profile=os.getenv("ENABLE_PROFILER", "").lower() in ("1", "true", "yes"))
 
 
 
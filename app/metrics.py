@@ -0,0 +1,269 @@
+# request instrumentation: latency per route, how many SQL queries a request made and how long they took
+# everything is kept in memory in this process and exposed in the prometheus text format on /metrics
+import heapq
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# the same SQL statement executed more times than this in one request is reported as a possible N+1
+N_PLUS_ONE_THRESHOLD = 10
+# the method label comes from the client, anything else is counted as OTHER so the number of series stays bounded
+HTTP_METHODS = frozenset({"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"})
+
+
+class RequestStats:
+    # the queries made during a single request
+    __slots__ = ("queries", "db_time", "statements", "starts")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = Counter()
+        # id(connection) -> start times of the statements running on it; kept here and not in conn.info
+        # so a statement that fails (no after_cursor_execute) leaves nothing behind on the pooled connection
+        self.starts = defaultdict(list)
+
+
+class Histogram:
+    # cumulative bucket counts, like a prometheus histogram
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+# the stats of the request that is currently running; None outside of a request so the SQL hooks do nothing
+_current = ContextVar("request_stats", default=None)
+
+latency = defaultdict(Histogram)     # (method, route) -> histogram of request time
+db_latency = defaultdict(Histogram)  # (method, route) -> histogram of the DB time of a request
+queries_total = Counter()            # (method, route) -> number of SQL queries
+n_plus_one_total = Counter()         # (method, route) -> requests with a repeated statement
+
+
+def install_sql_hooks(engine):
+    # count every statement sent through the engine and add its time to the current request
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        stats = _current.get()
+        if stats is not None:
+            stats.starts[id(conn)].append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        stats = _current.get()
+        if stats is None:
+            return
+        starts = stats.starts.get(id(conn))
+        if not starts:
+            return
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - starts.pop()
+        stats.statements[statement] += 1
+
+
+def record(key, elapsed, stats):
+    # add one finished request to the histograms and counters of its route
+    latency[key].observe(elapsed)
+    db_latency[key].observe(stats.db_time)
+    queries_total[key] += stats.queries
+
+    if stats.statements:
+        statement, repeats = stats.statements.most_common(1)[0]
+        if repeats > N_PLUS_ONE_THRESHOLD:
+            n_plus_one_total[key] += 1
+            logger.warning("possible N+1 on %s %s: statement ran %d times: %s", key[0], key[1], repeats, statement)
+
+
+def server_timing(stats, elapsed):
+    # Server-Timing shows up in the browser devtools next to the request
+    return f"db;desc=\"{stats.queries} queries\";dur={stats.db_time * 1000:.2f}, app;dur={elapsed * 1000:.2f}"
+
+
+class Profiler:
+    # sampling profiler: while requests are running a background thread takes the stacks of all threads every
+    # `interval` seconds and adds them to every running request; the `keep` slowest requests are kept with their stacks
+    # the samples are for the whole process, so with concurrent requests a request also sees the stacks of the others
+
+    # a thread whose innermost frame is in one of these files is waiting for work and is not sampled
+    IDLE_FILES = ("threading.py", "selectors.py", "queue.py")
+    MAX_DEPTH = 50
+
+    def __init__(self, interval=0.005, keep=10):
+        self.interval = interval
+        self.keep = keep
+        self.slowest = []       # min-heap of (elapsed, seq, (method, route), Counter of stacks)
+        self._running = {}      # seq -> Counter of stacks of a request that is still running
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start_request(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sample_forever, name="metrics-profiler", daemon=True)
+            self._thread.start()
+        seq = next(self._seq)
+        with self._lock:
+            self._running[seq] = Counter()
+        return seq
+
+    def finish_request(self, seq, key, elapsed):
+        with self._lock:
+            item = (elapsed, seq, key, self._running.pop(seq))
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, item)
+            elif elapsed > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def _fold(self, frame):
+        # one stack as "file:function;file:function;..." from the outermost call to the innermost
+        if os.path.basename(frame.f_code.co_filename) in self.IDLE_FILES:
+            return None
+        names = []
+        while frame is not None and len(names) < self.MAX_DEPTH:
+            names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def sample(self):
+        me = threading.get_ident()
+        stacks = [self._fold(frame) for ident, frame in sys._current_frames().items() if ident != me]
+        stacks = [stack for stack in stacks if stack]
+        with self._lock:
+            for samples in self._running.values():
+                samples.update(stacks)
+
+    def _sample_forever(self):
+        while True:
+            time.sleep(self.interval)
+            if self._running:
+                self.sample()
+
+    def render(self, top=20):
+        with self._lock:
+            slowest = sorted(self.slowest, reverse=True)
+            lines = []
+            for elapsed, _, (method, route), samples in slowest:
+                lines.append(f"# {method} {route} {elapsed * 1000:.2f}ms {sum(samples.values())} samples")
+                for stack, count in samples.most_common(top):
+                    lines.append(f"{count} {stack}")
+                lines.append("")
+        return "\n".join(lines)
+
+
+class TimingMiddleware:
+    # plain ASGI middleware and not @app.middleware("http"), that one (BaseHTTPMiddleware) starts an extra task group
+    # and streams every response through a memory channel, too much to leave on in production
+    def __init__(self, app, profiler=None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        seq = self.profiler.start_request() if self.profiler is not None else None
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(stats, time.perf_counter() - start).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            # also runs when the route raised, so the 500s end up in the histograms too
+            _current.reset(token)
+            # use the route template (/posts/{id}) and not the real path so every post id ends in the same series
+            route = scope.get("route")
+            method = scope["method"] if scope["method"] in HTTP_METHODS else "OTHER"
+            key = (method, route.path if route is not None else "unmatched")
+            elapsed = time.perf_counter() - start
+            record(key, elapsed, stats)
+            if self.profiler is not None:
+                self.profiler.finish_request(seq, key, elapsed)
+
+
+def _labels(key):
+    method, route = key
+    return f'method="{method}",route="{route}"'
+
+
+def _render_histogram(lines, name, help_text, histograms):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for key, hist in sorted(histograms.items()):
+        labels = _labels(key)
+        for bound, count in zip(BUCKETS, hist.counts):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {hist.count}')
+        lines.append(f"{name}_sum{{{labels}}} {hist.sum}")
+        lines.append(f"{name}_count{{{labels}}} {hist.count}")
+
+
+def _render_counter(lines, name, help_text, counter):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} counter")
+    for key, value in sorted(counter.items()):
+        lines.append(f"{name}{{{_labels(key)}}} {value}")
+
+
+def render():
+    lines = []
+    _render_histogram(lines, "http_request_duration_seconds", "Request latency by route.", latency)
+    _render_histogram(lines, "http_request_db_seconds", "Time spent in SQL queries per request.", db_latency)
+    _render_counter(lines, "http_request_queries_total", "SQL queries executed by route.", queries_total)
+    _render_counter(lines, "http_request_n_plus_one_total", "Requests that repeated one statement too often.", n_plus_one_total)
+    return "\n".join(lines) + "\n"
+
+
+router = APIRouter(tags=["Metrics"])
+
+
+# async def on purpose: a plain def runs in the threadpool and would read the dicts while the middleware changes them on the event loop
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    return render()
+
+
+def setup(app, engine, profile=False):
+    # called from main.py only when the metrics are turned on, so with them off nothing is added to the request path
+    # profile=True also starts the sampling profiler and serves the stacks of the slowest requests on /metrics/slow
+    install_sql_hooks(engine)
+    profiler = Profiler() if profile else None
+    app.add_middleware(TimingMiddleware, profiler=profiler)
+    app.include_router(router)
+    if profiler is not None:
+        async def slow_requests():
+            return profiler.render()
+
+        app.add_api_route("/metrics/slow", slow_requests, response_class=PlainTextResponse, include_in_schema=False)
+    return profiler
@@ -0,0 +1,181 @@
+import threading
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+
+from app import metrics
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    for store in (metrics.latency, metrics.db_latency, metrics.queries_total, metrics.n_plus_one_total):
+        store.clear()
+    yield
+
+
+def test_histogram_buckets_are_cumulative():
+    hist = metrics.Histogram()
+    for value in (0.001, 0.02, 0.3, 10.0):
+        hist.observe(value)
+
+    assert hist.count == 4
+    assert hist.sum == pytest.approx(10.321)
+    assert dict(zip(metrics.BUCKETS, hist.counts)) == {
+        0.005: 1, 0.01: 1, 0.025: 2, 0.05: 2, 0.1: 2, 0.25: 2, 0.5: 3, 1.0: 3, 2.5: 3, 5.0: 3,
+    }
+
+
+def test_render_prometheus_text():
+    stats = metrics.RequestStats()
+    stats.queries = 2
+    stats.db_time = 0.004
+    metrics.record(("GET", "/posts/{id}"), 0.02, stats)
+
+    body = metrics.render()
+    labels = 'method="GET",route="/posts/{id}"'
+    assert "# TYPE http_request_duration_seconds histogram" in body
+    assert f'http_request_duration_seconds_bucket{{{labels},le="0.01"}} 0' in body
+    assert f'http_request_duration_seconds_bucket{{{labels},le="0.025"}} 1' in body
+    assert f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 1' in body
+    assert f"http_request_duration_seconds_count{{{labels}}} 1" in body
+    assert f'http_request_db_seconds_bucket{{{labels},le="0.005"}} 1' in body
+    assert f"http_request_queries_total{{{labels}}} 2" in body
+    assert body.endswith("\n")
+
+
+def test_n_plus_one_threshold():
+    key = ("GET", "/posts")
+    stats = metrics.RequestStats()
+    stats.statements["SELECT * FROM votes WHERE post_id = ?"] = metrics.N_PLUS_ONE_THRESHOLD
+    metrics.record(key, 0.01, stats)
+    assert metrics.n_plus_one_total[key] == 0
+
+    stats.statements["SELECT * FROM votes WHERE post_id = ?"] += 1
+    metrics.record(key, 0.01, stats)
+    assert metrics.n_plus_one_total[key] == 1
+
+
+def test_server_timing_format():
+    stats = metrics.RequestStats()
+    stats.queries = 3
+    stats.db_time = 0.0015
+    assert metrics.server_timing(stats, 0.0125) == 'db;desc="3 queries";dur=1.50, app;dur=12.50'
+
+
+def test_middleware_counts_queries_and_failed_requests():
+    engine = create_engine("sqlite://")
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    def read_item(item_id: int):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+            conn.execute(text("SELECT 1"))
+        return {"id": item_id}
+
+    @app.get("/broken")
+    def broken():
+        raise RuntimeError("boom")
+
+    metrics.setup(app, engine)
+    client = TestClient(app, raise_server_exceptions=False)
+
+    response = client.get("/items/5")
+    assert response.status_code == 200
+    assert response.headers["server-timing"].startswith('db;desc="2 queries";dur=')
+    assert metrics.queries_total[("GET", "/items/{item_id}")] == 2
+
+    assert client.get("/broken").status_code == 500
+    assert metrics.latency[("GET", "/broken")].count == 1
+
+    assert "http_request_duration_seconds_count" in client.get("/metrics").text
+
+
+def test_unknown_methods_share_one_series():
+    app = FastAPI()
+    metrics.setup(app, create_engine("sqlite://"))
+    client = TestClient(app)
+
+    for method in ("FOO", "BAR", "BAZ"):
+        client.request(method, "/nope")
+        client.request(method, "/metrics")
+
+    assert metrics.latency[("OTHER", "unmatched")].count == 3
+    assert metrics.latency[("OTHER", "/metrics")].count == 3
+    assert {method for method, _ in metrics.latency} == {"OTHER"}
+
+
+def test_failed_statement_does_not_leak_start_time():
+    engine = create_engine("sqlite://")
+    metrics.install_sql_hooks(engine)
+    stats = metrics.RequestStats()
+    token = metrics._current.set(stats)
+    try:
+        with engine.connect() as conn:
+            with pytest.raises(Exception):
+                conn.execute(text("SELECT * FROM missing_table"))
+            conn.execute(text("SELECT 1"))
+            assert "query_start" not in conn.info
+    finally:
+        metrics._current.reset(token)
+    assert stats.queries == 1
+    assert stats.statements == {"SELECT 1": 1}
+
+
+def test_profiler_keeps_only_the_slowest_requests():
+    profiler = metrics.Profiler(keep=2)
+    for elapsed in (0.1, 0.5, 0.2, 0.05):
+        seq = profiler.start_request()
+        profiler.finish_request(seq, ("GET", "/posts"), elapsed)
+
+    assert sorted(item[0] for item in profiler.slowest) == [0.2, 0.5]
+    assert profiler.render().index("500.00ms") < profiler.render().index("200.00ms")
+
+
+def test_profiler_samples_running_requests():
+    # long interval so only the two sample() calls below are counted, not the background thread
+    profiler = metrics.Profiler(interval=60)
+    # plain list flags, a threading.Event would put the innermost frame of the handler in threading.py
+    busy, done = [], []
+
+    def handler():
+        busy.append(True)
+        while not done:
+            pass
+
+    worker = threading.Thread(target=handler)
+    worker.start()
+    while not busy:
+        time.sleep(0.001)
+    seq = profiler.start_request()
+    try:
+        profiler.sample()
+        profiler.sample()
+    finally:
+        done.append(True)
+        worker.join()
+    profiler.finish_request(seq, ("GET", "/posts"), 0.3)
+
+    _, _, _, samples = profiler.slowest[0]
+    assert sum(count for stack, count in samples.items() if stack.endswith("test_metrics.py:handler")) == 2
+    assert "test_metrics.py:handler" in profiler.render()
+
+
+def test_slow_requests_endpoint():
+    app = FastAPI()
+
+    @app.get("/slow")
+    def read_slow():
+        time.sleep(0.05)
+        return {}
+
+    metrics.setup(app, create_engine("sqlite://"), profile=True)
+    client = TestClient(app)
+    client.get("/slow")
+
+    body = client.get("/metrics/slow").text
+    assert body.startswith("# GET /slow ")
+    assert "test_metrics.py:read_slow" in body